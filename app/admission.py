@@ -0,0 +1,309 @@
+from collections import OrderedDict
+from starlette.responses import JSONResponse
+from app.utils.token_bucket import TokenBucket
+from app.profiling import timed_stage
+import asyncio
+import heapq
+import hmac
+import itertools
+import json
+import math
+import os
+
+# Request priorities: lower value is served first when a slot frees up
+SETTLEMENT = 0
+NORMAL = 1
+POLLING = 2
+
+# (method, path prefix, priority) - first match wins
+DEFAULT_PRIORITIES = [
+    ("POST", "/internal/credit", SETTLEMENT),
+    ("GET", "/balance", POLLING),
+    ("GET", "/transactions", POLLING),
+]
+
+# Share of the global queue each priority may fill before it is shed, so
+# polling is turned away long before settlement traffic is
+SHED_FRACTION = {SETTLEMENT: 1.0, NORMAL: 0.75, POLLING: 0.25}
+
+MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", "64"))
+MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2.0"))
+RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+CLIENT_RATE = float(os.getenv("ADMISSION_CLIENT_RATE", "50"))
+ACCOUNT_RATE = float(os.getenv("ADMISSION_ACCOUNT_RATE", "10"))
+# Comma-separated peer addresses exempt from rate limits. Empty by default:
+# behind a local reverse proxy, or with everything on localhost, a peer
+# address does not tell the clearing house apart from anyone else.
+EXEMPT_CLIENTS = {
+    c.strip() for c in os.getenv("ADMISSION_EXEMPT_CLIENTS", "").split(",") if c.strip()
+}
+# Secret shared by the banks and the clearing house. Settlement legs that
+# carry it in the X-Settlement-Token header skip rate limits.
+SETTLEMENT_TOKEN = os.getenv("SETTLEMENT_TOKEN")
+SETTLEMENT_TOKEN_HEADER = "X-Settlement-Token"
+SETTLEMENT_LEGS = {("POST", "/transfer"), ("POST", "/internal/credit")}
+# Comma-separated proxy addresses whose X-Client-Id header is trusted to
+# name the real client. From anyone else the header is ignored.
+TRUSTED_PROXIES = {
+    c.strip() for c in os.getenv("ADMISSION_TRUSTED_PROXIES", "").split(",") if c.strip()
+}
+
+DEFAULT_ROUTE_LIMITS = {"/balance": 16, "/transactions": 16}
+
+ACCOUNT_FIELDS = ("from_account", "account_id", "account_holder")
+MAX_INSPECTED_BODY = 64 * 1024
+
+
+class PriorityLimiter:
+    """Concurrency limit whose waiters are woken in priority order"""
+
+    def __init__(self, limit: int, max_queue: int):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters = []
+        self._seq = itertools.count()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: int, timeout: float) -> bool:
+        """
+        Take a slot, queueing up to `timeout` seconds. False if shed.
+        With `timeout=None` the caller is never shed: it bypasses the queue
+        cap and waits as long as it takes.
+        """
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        if timeout is not None and len(self._waiters) >= self.max_queue:
+            return False
+
+        fut = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), fut)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(fut, timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            if fut.done() and not fut.cancelled():
+                # The slot was handed over just as we gave up - pass it on
+                self.release()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+
+    def release(self):
+        """Hand the slot to the highest-priority waiter, or free it"""
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(True)
+                return
+        self.active -= 1
+
+
+class AdmissionControl:
+    """
+    ASGI middleware that bounds in-flight work:
+    - per-client and per-account token-bucket rate limits (429)
+    - per-route concurrency limits and a global priority queue
+    - load shedding by queue depth, lowest priority first (503)
+    Settlement credits skip rate limits, jump the queue and are never shed.
+    Rate limits key on the peer address; X-Client-Id is only honoured from
+    trusted proxies. Settlement legs from the clearing house, identified by
+    the shared SETTLEMENT_TOKEN, are exempt from rate limits.
+    """
+
+    def __init__(
+        self,
+        app,
+        max_concurrency: int = MAX_CONCURRENCY,
+        max_queue: int = MAX_QUEUE,
+        queue_timeout: float = QUEUE_TIMEOUT,
+        route_limits: dict = None,
+        priorities: list = None,
+        client_rate: float = CLIENT_RATE,
+        account_rate: float = ACCOUNT_RATE,
+        exempt_clients: set = None,
+        trusted_proxies: set = None,
+        settlement_token: str = None,
+    ):
+        self.app = app
+        self.queue_timeout = queue_timeout
+        self.limiter = PriorityLimiter(max_concurrency, max_queue)
+        route_limits = DEFAULT_ROUTE_LIMITS if route_limits is None else route_limits
+        self.route_limiters = {
+            prefix: PriorityLimiter(limit, max_queue)
+            for prefix, limit in route_limits.items()
+        }
+        self.priorities = DEFAULT_PRIORITIES if priorities is None else priorities
+        self.client_rate = client_rate
+        self.account_rate = account_rate
+        self.exempt_clients = EXEMPT_CLIENTS if exempt_clients is None else exempt_clients
+        self.trusted_proxies = TRUSTED_PROXIES if trusted_proxies is None else trusted_proxies
+        self.settlement_token = SETTLEMENT_TOKEN if settlement_token is None else settlement_token
+        self.client_buckets = OrderedDict()
+        self.account_buckets = OrderedDict()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        path = scope["path"]
+        priority = self._priority(method, path)
+
+        if priority != SETTLEMENT and not self._is_settlement_leg(scope):
+            peer = self._peer(scope)
+            if peer not in self.exempt_clients:
+                client_id = self._client_id(scope, peer)
+                account_id, receive = await self._account_id(scope, receive)
+                delay = self._rate_limit(self.client_buckets, client_id, self.client_rate)
+                if not delay and account_id:
+                    delay = self._rate_limit(
+                        self.account_buckets, account_id, self.account_rate
+                    )
+                if delay:
+                    await self._reject(scope, receive, send, 429, "Rate limit exceeded", delay)
+                    return
+
+        # Settlement credits arrive after the sender was already debited, so
+        # turning them away would lose money: they wait instead
+        timeout = None if priority == SETTLEMENT else self.queue_timeout
+        if timeout is not None and (
+            self.limiter.queued >= self.limiter.max_queue * SHED_FRACTION[priority]
+        ):
+            await self._reject(scope, receive, send, 503, "Server overloaded", RETRY_AFTER)
+            return
+
+        route_limiter = self._route_limiter(path)
+        if route_limiter:
+            with timed_stage("admission.queue"):
+                admitted = await route_limiter.acquire(priority, timeout)
+            if not admitted:
+                await self._reject(scope, receive, send, 503, "Server overloaded", RETRY_AFTER)
+                return
+        try:
+            with timed_stage("admission.queue"):
+                admitted = await self.limiter.acquire(priority, timeout)
+            if not admitted:
+                await self._reject(scope, receive, send, 503, "Server overloaded", RETRY_AFTER)
+                return
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                self.limiter.release()
+        finally:
+            if route_limiter:
+                route_limiter.release()
+
+    def _priority(self, method: str, path: str) -> int:
+        for rule_method, prefix, priority in self.priorities:
+            if method == rule_method and path.startswith(prefix):
+                return priority
+        return NORMAL
+
+    def _route_limiter(self, path: str):
+        for prefix, limiter in self.route_limiters.items():
+            if path.startswith(prefix):
+                return limiter
+        return None
+
+    def _peer(self, scope) -> str:
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    def _is_settlement_leg(self, scope) -> bool:
+        if not self.settlement_token or (scope["method"], scope["path"]) not in SETTLEMENT_LEGS:
+            return False
+        header = SETTLEMENT_TOKEN_HEADER.lower().encode("latin-1")
+        for name, value in scope.get("headers", []):
+            if name == header:
+                return hmac.compare_digest(value, self.settlement_token.encode("latin-1"))
+        return False
+
+    def _client_id(self, scope, peer: str) -> str:
+        if peer in self.trusted_proxies:
+            for name, value in scope.get("headers", []):
+                if name == b"x-client-id":
+                    return value.decode("latin-1")
+        return peer
+
+    async def _account_id(self, scope, receive):
+        """
+        Find the account a request acts on, from the path for GETs or the
+        JSON body for POSTs. Returns the id and a receive callable that
+        replays any body that had to be read.
+        """
+        parts = scope["path"].strip("/").split("/")
+        if scope["method"] == "GET":
+            if len(parts) == 2 and parts[0] in ("balance", "transactions"):
+                return parts[1].upper(), receive
+            return None, receive
+
+        if scope["method"] != "POST":
+            return None, receive
+        headers = dict(scope.get("headers", []))
+        try:
+            length = int(headers.get(b"content-length", b"0"))
+        except ValueError:
+            return None, receive
+        if not length or length > MAX_INSPECTED_BODY:
+            return None, receive
+
+        messages = []
+        body = b""
+        while True:
+            message = await receive()
+            messages.append(message)
+            if message["type"] != "http.request":
+                break
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        async def replay():
+            if messages:
+                return messages.pop(0)
+            return await receive()
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None, replay
+        if not isinstance(data, dict):
+            return None, replay
+        for field in ACCOUNT_FIELDS:
+            if isinstance(data.get(field), str) and data[field]:
+                return data[field].upper(), replay
+        return None, replay
+
+    def _rate_limit(self, buckets: OrderedDict, key: str, rate: float) -> float:
+        """Take one token for `key`; returns seconds to wait if none left"""
+        if rate <= 0:
+            return 0.0
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, capacity=rate * 2)
+            if len(buckets) > 10000:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        if bucket.try_acquire():
+            return 0.0
+        return bucket.delay_for()
+
+    async def _reject(self, scope, receive, send, status: int, detail: str, retry_after):
+        response = JSONResponse(
+            status_code=status,
+            content={"detail": detail},
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+        await response(scope, receive, send)
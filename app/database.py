@@ -1,7 +1,14 @@
 from azure.cosmos import CosmosClient, PartitionKey
+from azure.core import MatchConditions
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+from azure.cosmos.exceptions import CosmosHttpResponseError
 from dotenv import load_dotenv
+from app.utils.token_bucket import TokenBucket
+from app.profiling import timed_stage
+import asyncio
 import os
 import base64
+import random
 
 load_dotenv()
 
@@ -11,6 +18,14 @@ COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
 COSMOS_KEY = os.getenv("COSMOS_KEY", "").strip()
 COSMOS_DATABASE_PREFIX = os.getenv("COSMOS_DATABASE_PREFIX", "mock-bank-db")
 
+# Request unit budget per container. Calls wait on a shared token bucket
+# instead of bursting into 429s, and throttled calls are retried with
+# jittered backoff honouring the service's retry-after hint.
+COSMOS_RU_PER_SECOND = float(os.getenv("COSMOS_RU_PER_SECOND", "400"))
+COSMOS_MAX_RETRIES = int(os.getenv("COSMOS_MAX_RETRIES", "5"))
+COSMOS_BACKOFF_BASE = float(os.getenv("COSMOS_BACKOFF_BASE", "0.05"))
+COSMOS_BACKOFF_MAX = float(os.getenv("COSMOS_BACKOFF_MAX", "2.0"))
+
 if not COSMOS_ENDPOINT or not COSMOS_KEY:
     raise RuntimeError(
         "COSMOS_ENDPOINT and COSMOS_KEY must be set in your environment variables."
@@ -25,76 +40,250 @@ except Exception:
     )
 
 # Initialize Cosmos Client
-cosmos_client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
+# Throttle retries are handled by CosmosContainer with non-blocking sleeps,
+# so keep the SDK's own (blocking) 429 backoff short.
+cosmos_client = CosmosClient(
+    COSMOS_ENDPOINT, COSMOS_KEY, retry_throttle_total=1, retry_throttle_backoff_max=1
+)
+
+# Maximum operations Cosmos DB accepts in one transactional batch
+COSMOS_BATCH_LIMIT = 100
+
+REQUEST_CHARGE_HEADER = "x-ms-request-charge"
+RETRY_AFTER_MS_HEADER = "x-ms-retry-after-ms"
+
+
+class StorageError(Exception):
+    """Raised when a Cosmos DB operation fails (as opposed to finding nothing)"""
+
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class StorageUnavailableError(StorageError):
+    """Raised for transient failures (throttling, 5xx, timeouts) worth retrying"""
+
+
+class StorageThrottledError(StorageUnavailableError):
+    """Raised when a Cosmos DB operation is still throttled after all retries"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message, status_code=429)
+        self.retry_after = retry_after
 
 
 class CosmosContainer:
     """Wrapper to provide MongoDB-like interface for Azure Cosmos DB operations"""
 
-    def __init__(self, container):
+    def __init__(self, container, ru_budget: TokenBucket = None):
         self.container = container
+        self.ru_budget = ru_budget or TokenBucket(COSMOS_RU_PER_SECOND)
+        # Running estimate of the RU cost of one call per operation, used to
+        # reserve budget before the actual charge is known. Kept separate so
+        # large batch writes do not inflate reservations for point reads.
+        self.estimated_charges = {}
+        self.last_request_charge = 0.0
 
-    async def find_one(self, query: dict, projection: dict = None):
-        """Find a single document matching query"""
-        try:
-            # Build SQL query from dict query
+    async def _execute(self, operation: str, fn):
+        """
+        Run `fn(response_hook)` against the RU budget, retrying 429s with
+        jittered exponential backoff. Transient failures raise
+        StorageUnavailableError, anything else StorageError.
+        """
+        attempt = 0
+        while True:
+            reserved = self.estimated_charges.get(operation, 1.0)
+            with timed_stage("cosmos.ru_wait"):
+                await self.ru_budget.acquire(reserved)
+            charges = []
+
+            def response_hook(headers, _result, charges=charges):
+                charges.append(float(headers.get(REQUEST_CHARGE_HEADER, 0) or 0))
+
+            def call(loop=asyncio.get_running_loop(), reserved=reserved, charges=charges):
+                try:
+                    return fn(response_hook)
+                finally:
+                    # Settle once the SDK call has really finished, even if
+                    # the awaiting coroutine was cancelled in the meantime
+                    try:
+                        loop.call_soon_threadsafe(
+                            self._settle_charge, operation, reserved, charges
+                        )
+                    except RuntimeError:
+                        pass  # Event loop already closed
+
+            try:
+                # The SDK is blocking; run it off the event loop so
+                # independent calls can overlap
+                with timed_stage(f"cosmos.{operation}"):
+                    return await asyncio.to_thread(call)
+            except CosmosHttpResponseError as e:
+                if e.status_code != 429:
+                    print(f"Error in {operation}: {e}")
+                    if e.status_code == 408 or e.status_code >= 500:
+                        raise StorageUnavailableError(str(e), status_code=e.status_code) from e
+                    raise StorageError(str(e), status_code=e.status_code) from e
+
+                retry_after = float(e.headers.get(RETRY_AFTER_MS_HEADER, 0) or 0) / 1000
+                self.ru_budget.pause(retry_after)
+                if attempt >= COSMOS_MAX_RETRIES:
+                    print(f"Throttled in {operation}, giving up after {attempt} retries")
+                    raise StorageThrottledError(
+                        f"{operation} throttled", retry_after=retry_after
+                    ) from e
+            except (ServiceRequestError, ServiceResponseError, TimeoutError) as e:
+                print(f"Error in {operation}: {e}")
+                raise StorageUnavailableError(str(e)) from e
+            except Exception as e:
+                print(f"Error in {operation}: {e}")
+                raise StorageError(str(e)) from e
+
+            backoff = min(COSMOS_BACKOFF_MAX, COSMOS_BACKOFF_BASE * 2**attempt)
+            with timed_stage("cosmos.throttle_backoff"):
+                await asyncio.sleep(retry_after + random.uniform(0, backoff))
+            attempt += 1
+
+    def _settle_charge(self, operation: str, reserved: float, charges: list):
+        """Charge the budget for the difference between reserved and actual RUs"""
+        if not charges:
+            return
+        actual = sum(charges)
+        self.last_request_charge = actual
+        self.ru_budget.charge(actual - reserved)
+        estimate = self.estimated_charges.get(operation, 1.0)
+        self.estimated_charges[operation] = 0.8 * estimate + 0.2 * actual
+
+    def _query(self, query: dict):
+        """Build a call that runs the query and drains every page"""
+        with timed_stage("build_sql"):
             sql_query = self._build_sql_where(query)
-            items = list(
-                self.container.query_items(
-                    query=sql_query, enable_cross_partition_query=True
-                )
+        return lambda hook: list(
+            self.container.query_items(
+                query=sql_query,
+                enable_cross_partition_query=True,
+                response_hook=hook,
             )
-            return items[0] if items else None
-        except Exception as e:
-            print(f"Error in find_one: {e}")
-            return None
+        )
+
+    async def find_one(self, query: dict, projection: dict = None):
+        """Find a single document matching query"""
+        items = await self._execute("find_one", self._query(query))
+        return items[0] if items else None
 
     async def find(self, query: dict):
         """Find multiple documents matching query"""
-        try:
-            sql_query = self._build_sql_where(query)
-            items = list(
-                self.container.query_items(
-                    query=sql_query, enable_cross_partition_query=True
-                )
-            )
-            return items
-        except Exception as e:
-            print(f"Error in find: {e}")
-            return []
+        return await self._execute("find", self._query(query))
 
     async def insert_one(self, document: dict):
         """Insert a single document"""
-        try:
-            return self.container.create_item(body=document)
-        except Exception as e:
-            print(f"Error in insert_one: {e}")
-            raise
+        return await self._execute(
+            "insert_one",
+            lambda hook: self.container.create_item(
+                body=document, response_hook=hook
+            ),
+        )
+
+    async def bulk_upsert(self, documents: list, partition_key_field: str = "type"):
+        """
+        Upsert documents in transactional batches, one per partition key
+        value and at most COSMOS_BATCH_LIMIT operations each
+        """
+        groups = {}
+        for document in documents:
+            groups.setdefault(document.get(partition_key_field), []).append(document)
+
+        for partition_key, group in groups.items():
+            for start in range(0, len(group), COSMOS_BATCH_LIMIT):
+                operations = [
+                    ("upsert", (document,))
+                    for document in group[start : start + COSMOS_BATCH_LIMIT]
+                ]
+                await self._execute(
+                    "bulk_upsert",
+                    lambda hook, operations=operations, partition_key=partition_key: (
+                        self.container.execute_item_batch(
+                            batch_operations=operations,
+                            partition_key=partition_key,
+                            response_hook=hook,
+                        )
+                    ),
+                )
 
-    async def update_one(self, query: dict, update: dict):
-        """Update a single document"""
+    async def update_one(
+        self, query: dict, update: dict, document: dict = None, check=None
+    ):
+        """
+        Update a single document.
+        The write only succeeds if the document is unchanged since it was
+        read (ETag match). On a conflict it is re-read, `check(item)` runs
+        again (raise from it to abort) and the update is re-applied.
+        Pass an already-fetched `document` to skip the first read.
+        """
         try:
-            # Get the document first
-            item = await self.find_one(query)
-            if not item:
-                return None
-
-            # Apply update operations
-            if "$inc" in update:
-                for field, value in update["$inc"].items():
-                    item[field] = item.get(field, 0) + value
-            elif "$set" in update:
-                for field, value in update["$set"].items():
-                    item[field] = value
-            else:
-                item.update(update)
+            item = document
+            for attempt in range(COSMOS_MAX_RETRIES + 1):
+                # Get the document first
+                if attempt or not item:
+                    item = await self.find_one(query)
+                if not item:
+                    return None
+                if check:
+                    check(item)
+
+                updated = self._apply_update(dict(item), update)
+                conditions = {}
+                if item.get("_etag"):
+                    conditions = {
+                        "etag": item["_etag"],
+                        "match_condition": MatchConditions.IfNotModified,
+                    }
+
+                # Replace the item
+                try:
+                    return await self._execute(
+                        "update_one",
+                        lambda hook: self.container.replace_item(
+                            item=updated["id"], body=updated, response_hook=hook, **conditions
+                        ),
+                    )
+                except StorageError as e:
+                    if e.status_code != 412:
+                        raise
+                    print(f"Conflict in update_one, re-reading {updated['id']}")
+                    # Spread out writers racing on the same document
+                    backoff = min(COSMOS_BACKOFF_MAX, COSMOS_BACKOFF_BASE * 2**attempt)
+                    await asyncio.sleep(random.uniform(0, backoff))
 
-            # Replace the item
-            return self.container.replace_item(item=item["id"], body=item)
+            raise StorageUnavailableError("update_one kept conflicting", status_code=412)
         except Exception as e:
             print(f"Error in update_one: {e}")
             raise
 
+    def _apply_update(self, item: dict, update: dict) -> dict:
+        """
+        Apply MongoDB-style update operations to a document.
+        Supports $inc, $set and $push (with optional $each/$slice).
+        """
+        if not any(op in update for op in ("$inc", "$set", "$push")):
+            item.update(update)
+            return item
+        for field, value in update.get("$inc", {}).items():
+            item[field] = item.get(field, 0) + value
+        for field, value in update.get("$set", {}).items():
+            item[field] = value
+        for field, value in update.get("$push", {}).items():
+            values = list(item.get(field) or [])
+            if isinstance(value, dict) and "$each" in value:
+                values.extend(value["$each"])
+                if "$slice" in value:
+                    values = values[value["$slice"] :] if value["$slice"] < 0 else values[: value["$slice"]]
+            else:
+                values.append(value)
+            item[field] = values
+        return item
+
     def _build_sql_where(self, query: dict) -> str:
         """Convert MongoDB-style query dict to SQL WHERE clause"""
         conditions = []
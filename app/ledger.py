@@ -0,0 +1,266 @@
+from collections import OrderedDict
+from pathlib import Path
+from app.profiling import timed_stage
+import asyncio
+import json
+import os
+import random
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Setting LEDGER_WAL_DIR turns on the write-behind ledger. Ledger rows are
+# acknowledged once they are fsynced to a local write-ahead log and reach
+# the transactions container later, in bulk.
+LEDGER_WAL_DIR = os.getenv("LEDGER_WAL_DIR")
+LEDGER_FSYNC_INTERVAL = float(os.getenv("LEDGER_FSYNC_INTERVAL_MS", "5")) / 1000
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL_MS", "50")) / 1000
+LEDGER_FLUSH_BATCH = int(os.getenv("LEDGER_FLUSH_BATCH", "500"))
+LEDGER_RETRY_MAX = float(os.getenv("LEDGER_RETRY_MAX", "5.0"))
+# Rewrite the WAL without flushed rows after this many acknowledgements
+LEDGER_COMPACT_AFTER = int(os.getenv("LEDGER_COMPACT_AFTER", "10000"))
+
+
+class LedgerWriter:
+    """
+    Group-commit, write-behind front for the transactions container.
+
+    insert_one() appends the row to a local WAL; rows arriving within one
+    fsync interval share a single fsync. A background task upserts durable
+    rows into the container in bulk and records their ids in an ack log.
+    On start, rows in the WAL without an ack are flushed again - upserts
+    make the replay idempotent.
+    Reads merge rows that are durable but not yet flushed, so idempotency
+    checks and history see them immediately.
+    Only one process may own a WAL directory; start() fails if another
+    worker holds its lock file.
+    """
+
+    def __init__(self, transactions, wal_dir):
+        self.transactions = transactions
+        self.wal_dir = Path(wal_dir)
+        self.wal_path = self.wal_dir / "ledger.wal"
+        self.ack_path = self.wal_dir / "ledger.ack"
+        self.lock_path = self.wal_dir / "ledger.lock"
+        self._lock_file = None
+        self._buffer = []
+        self._pending = OrderedDict()
+        self._acked_since_compact = 0
+        self._wal_lock = asyncio.Lock()
+        self._wal = None
+        self._ack = None
+        self._tasks = []
+        self._stopping = False
+
+    async def start(self):
+        """Recover unflushed rows from disk and start the background tasks"""
+        self.wal_dir.mkdir(parents=True, exist_ok=True)
+        self._lock_file = _lock_exclusive(self.lock_path)
+        recovered = self._recover()
+        if recovered:
+            print(f"♻️  Recovered {recovered} unflushed ledger rows from {self.wal_path}")
+        self._wal = open(self.wal_path, "a", encoding="utf-8")
+        self._ack = open(self.ack_path, "a", encoding="utf-8")
+        self._stopping = False
+        self._tasks = [
+            asyncio.create_task(self._commit_loop()),
+            asyncio.create_task(self._flush_loop()),
+        ]
+
+    async def stop(self):
+        """Commit and flush what is left, then close the logs"""
+        if self._wal is None:
+            return
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+        await self._commit()
+        try:
+            await self._flush()
+        except Exception as e:
+            # Rows stay in the WAL and are flushed on the next start
+            print(f"Ledger flush on shutdown failed: {e}")
+        self._wal.close()
+        self._ack.close()
+        self._wal = self._ack = None
+        self._lock_file.close()
+        self._lock_file = None
+
+    async def insert_one(self, document: dict):
+        """Append a row; returns once it is durable in the WAL"""
+        if self._stopping or not self._tasks:
+            raise RuntimeError("Ledger writer is not running")
+        fut = asyncio.get_running_loop().create_future()
+        self._buffer.append((document, fut))
+        with timed_stage("ledger.wal_commit"):
+            await fut
+        return document
+
+    async def find_one(self, query: dict, projection: dict = None):
+        """Find a single document, including rows not yet flushed"""
+        for document in self._pending.values():
+            if _matches(document, query):
+                return document
+        return await self.transactions.find_one(query, projection)
+
+    async def find(self, query: dict):
+        """Find multiple documents, including rows not yet flushed"""
+        items = await self.transactions.find(query)
+        seen = {item.get("id") for item in items}
+        items.extend(
+            document
+            for document in self._pending.values()
+            if document["id"] not in seen and _matches(document, query)
+        )
+        return items
+
+    async def update_one(self, query: dict, update: dict, document: dict = None, check=None):
+        return await self.transactions.update_one(
+            query, update, document=document, check=check
+        )
+
+    def _recover(self) -> int:
+        acked = set()
+        if self.ack_path.exists():
+            with open(self.ack_path, encoding="utf-8") as f:
+                acked = {line.strip() for line in f if line.strip()}
+        if self.wal_path.exists():
+            data = self.wal_path.read_bytes()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                # Torn write from a crash mid-append; it was never acknowledged.
+                # Cut it off, or the next append would be glued onto it and
+                # lost on the following recovery.
+                _truncate_and_sync(self.wal_path, end)
+                data = data[:end]
+            for line in data.decode("utf-8").splitlines():
+                try:
+                    document = json.loads(line)
+                except ValueError:
+                    continue
+                if document["id"] not in acked:
+                    self._pending[document["id"]] = document
+        return len(self._pending)
+
+    async def _commit_loop(self):
+        while True:
+            await asyncio.sleep(LEDGER_FSYNC_INTERVAL)
+            await self._commit()
+
+    async def _commit(self):
+        """Write and fsync every buffered row, then acknowledge them together"""
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        data = "".join(json.dumps(document) + "\n" for document, _ in batch)
+        try:
+            async with self._wal_lock:
+                await asyncio.to_thread(_append_and_sync, self._wal, data)
+        except Exception as e:
+            print(f"Ledger WAL write failed: {e}")
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for document, fut in batch:
+            self._pending[document["id"]] = document
+            if not fut.done():
+                fut.set_result(None)
+
+    async def _flush_loop(self):
+        failures = 0
+        while True:
+            await asyncio.sleep(LEDGER_FLUSH_INTERVAL)
+            try:
+                await self._flush()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                delay = min(LEDGER_RETRY_MAX, LEDGER_FLUSH_INTERVAL * 2**failures)
+                print(f"Ledger flush failed (attempt {failures}): {e}")
+                await asyncio.sleep(random.uniform(0, delay))
+
+    async def _flush(self):
+        """Push durable rows to the container in bulk, then record their ids"""
+        while self._pending:
+            batch = list(self._pending.values())[:LEDGER_FLUSH_BATCH]
+            await self.transactions.bulk_upsert(batch)
+
+            # The ack log is not fsynced: losing it only means re-upserting
+            # rows that are already in the container
+            ids = [document["id"] for document in batch]
+            self._ack.write("".join(f"{doc_id}\n" for doc_id in ids))
+            self._ack.flush()
+            for doc_id in ids:
+                self._pending.pop(doc_id, None)
+            self._acked_since_compact += len(ids)
+
+            if not self._pending or self._acked_since_compact >= LEDGER_COMPACT_AFTER:
+                await self._compact()
+
+    async def _compact(self):
+        """Rewrite the WAL with only unflushed rows and clear the ack log"""
+        # stop() cancels the flush loop. Once the old WAL is replaced the new
+        # one must be opened, or later commits would go to the unlinked file.
+        await asyncio.shield(self._swap_wal())
+
+    async def _swap_wal(self):
+        async with self._wal_lock:
+            data = "".join(json.dumps(document) + "\n" for document in self._pending.values())
+            await asyncio.to_thread(_replace_and_sync, self.wal_path, data)
+            self._wal.close()
+            self._wal = open(self.wal_path, "a", encoding="utf-8")
+            self._ack.close()
+            self._ack = open(self.ack_path, "w", encoding="utf-8")
+            self._acked_since_compact = 0
+
+
+def _matches(document: dict, query: dict) -> bool:
+    return all(document.get(key) == value for key, value in query.items())
+
+
+def _append_and_sync(f, data: str):
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def _replace_and_sync(path: Path, data: str):
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _truncate_and_sync(path: Path, size: int):
+    with open(path, "r+b") as f:
+        f.truncate(size)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _lock_exclusive(path: Path):
+    """Open `path` and hold an exclusive lock on it for as long as it is open"""
+    f = open(path, "a+")
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        f.close()
+        raise RuntimeError(
+            f"Ledger WAL {path.parent} is in use by another process; "
+            "give each worker its own LEDGER_WAL_DIR"
+        )
+    return f
@@ -1,15 +1,33 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
-from app.database import get_database
+from app.database import (
+    get_database,
+    StorageError,
+    StorageThrottledError,
+    StorageUnavailableError,
+)
+from app.admission import AdmissionControl
+from app.ledger import LedgerWriter, LEDGER_WAL_DIR
+from app.profiling import SlowRequestCapture, SlowRequestLog, TimedJSONResponse
 from app.routes.accounts import get_accounts_router
 from app.routes.transactions import get_transactions_router
 from app.routes.pay_bills import get_pay_bills_router
+from app.routes.profiling import get_profiling_router
+import math
+import os
 
 
 def create_app(bank_name: str):
     db_ctx = get_database(bank_name)
     client = db_ctx["client"]
 
+    transactions = db_ctx["transactions"]
+    ledger = None
+    if LEDGER_WAL_DIR:
+        ledger = LedgerWriter(transactions, os.path.join(LEDGER_WAL_DIR, bank_name.lower()))
+        transactions = ledger
+
     @asynccontextmanager
     async def lifespan(app: FastAPI):
         try:
@@ -19,24 +37,54 @@ def create_app(bank_name: str):
         except Exception as e:
             print("❌ Azure Cosmos DB connection failed")
             raise e
+        if ledger:
+            await ledger.start()
+            print(f"✅ Write-behind ledger enabled at {ledger.wal_dir}")
         yield
+        if ledger:
+            await ledger.stop()
 
-    app = FastAPI(title=f"{bank_name.upper()} API", lifespan=lifespan)
+    app = FastAPI(
+        title=f"{bank_name.upper()} API",
+        lifespan=lifespan,
+        default_response_class=TimedJSONResponse,
+    )
+    slow_requests = SlowRequestLog()
+    app.add_middleware(AdmissionControl)
+    # Added last so it is outermost and sees admission queueing time too
+    app.add_middleware(SlowRequestCapture, log=slow_requests)
+
+    @app.exception_handler(StorageError)
+    async def storage_error_handler(request: Request, exc: StorageError):
+        # Storage failures are not "not found". Only transient ones are
+        # reported as unavailable, since 503 invites the client to retry.
+        if not isinstance(exc, StorageUnavailableError):
+            return JSONResponse(status_code=500, content={"detail": "Storage error"})
+        headers = {}
+        if isinstance(exc, StorageThrottledError):
+            headers["Retry-After"] = str(max(1, math.ceil(exc.retry_after)))
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Storage temporarily unavailable"},
+            headers=headers,
+        )
 
     app.include_router(get_accounts_router(db_ctx["accounts"], bank_name))
 
     app.include_router(
         get_transactions_router(
-            db_ctx["accounts"], db_ctx["transactions"], client, bank_name
+            db_ctx["accounts"], transactions, client, bank_name
         )
     )
 
     app.include_router(
         get_pay_bills_router(
-            db_ctx["accounts"], db_ctx["transactions"], client, bank_name
+            db_ctx["accounts"], transactions, client, bank_name
         )
     )
 
+    app.include_router(get_profiling_router(slow_requests))
+
     @app.get("/")
     def root():
         return {"bank": bank_name, "status": "running"}
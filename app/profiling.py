@@ -0,0 +1,198 @@
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from starlette.responses import JSONResponse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+# Requests slower than this get their per-stage timings captured
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+SLOW_REQUEST_BUFFER = int(os.getenv("SLOW_REQUEST_BUFFER", "200"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+# Admin endpoints (profiling runs last for seconds) are never captured
+EXCLUDED_PREFIXES = ("/admin/",)
+
+# Stage timings of the request being handled, shared with worker threads and
+# tasks started from it (both copy the context, not the dict)
+_current_stages = ContextVar("current_stages", default=None)
+
+
+class timed_stage:
+    """
+    Record how long a block takes under `name` for the current request:
+
+        with timed_stage("cosmos.find_one"):
+            ...
+
+    Does nothing outside a request captured by SlowRequestCapture.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stages = None
+
+    def __enter__(self):
+        self.stages = _current_stages.get()
+        if self.stages is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.stages is not None:
+            elapsed = (time.perf_counter() - self.start) * 1000
+            stage = self.stages.setdefault(self.name, {"count": 0, "total_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] += elapsed
+        return False
+
+
+class SlowRequestLog:
+    """Bounded ring buffer of requests that took longer than `threshold_ms`"""
+
+    def __init__(self, threshold_ms: float = SLOW_REQUEST_MS, size: int = SLOW_REQUEST_BUFFER):
+        self.threshold_ms = threshold_ms
+        self.requests = deque(maxlen=size)
+
+
+class SlowRequestCapture:
+    """
+    ASGI middleware that times every request and records the per-stage
+    breakdown of slow ones in a SlowRequestLog. Admin endpoints are skipped.
+    """
+
+    def __init__(self, app, log: SlowRequestLog):
+        self.app = app
+        self.log = log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(EXCLUDED_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        stages = {}
+        status = None
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = _current_stages.set(stages)
+        started_at = datetime.now(timezone.utc)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            _current_stages.reset(token)
+            if duration_ms >= self.log.threshold_ms:
+                accounted = sum(stage["total_ms"] for stage in stages.values())
+                self.log.requests.append(
+                    {
+                        "method": scope["method"],
+                        "path": scope["path"],
+                        "status": status,
+                        "started_at": started_at.isoformat(),
+                        "duration_ms": round(duration_ms, 3),
+                        "stages": {
+                            name: {"count": stage["count"], "total_ms": round(stage["total_ms"], 3)}
+                            for name, stage in stages.items()
+                        },
+                        # Time spent outside any instrumented stage (routing,
+                        # validation, handler code); stages may overlap
+                        "unaccounted_ms": round(max(0.0, duration_ms - accounted), 3),
+                    }
+                )
+
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse that records its encoding time as a stage"""
+
+    def render(self, content) -> bytes:
+        with timed_stage("json_encode"):
+            return super().render(content)
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread at a fixed interval from a
+    dedicated background thread. Only one profile runs at a time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = False
+
+    async def run(self, seconds: float, interval: float) -> dict:
+        """
+        Profile on a thread of its own rather than the default executor,
+        which is busy with Cosmos DB calls
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        def resolve(result, error):
+            if fut.done():
+                return
+            if error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result(result)
+
+        def target():
+            try:
+                result = self.profile(seconds, interval)
+            except Exception as e:
+                loop.call_soon_threadsafe(resolve, None, e)
+            else:
+                loop.call_soon_threadsafe(resolve, result, None)
+
+        threading.Thread(target=target, name="sampling-profiler", daemon=True).start()
+        return await fut
+
+    def profile(self, seconds: float, interval: float) -> dict:
+        """Block for `seconds` and return collapsed stacks with sample counts"""
+        with self._lock:
+            if self.running:
+                raise RuntimeError("A profile is already running")
+            self.running = True
+        try:
+            return self._sample(seconds, interval)
+        finally:
+            self.running = False
+
+    def _sample(self, seconds: float, interval: float) -> dict:
+        own_id = threading.get_ident()
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        stacks = Counter()
+        samples = 0
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stacks[_collapse(frame, thread_names.get(thread_id, str(thread_id)))] += 1
+            samples += 1
+            time.sleep(interval)
+            if samples % 100 == 0:
+                thread_names = {t.ident: t.name for t in threading.enumerate()}
+        return {"samples": samples, "interval_ms": interval * 1000, "stacks": stacks}
+
+
+def _collapse(frame, thread_name: str) -> str:
+    """Render a frame as a root-first `a;b;c` line for flamegraph tools"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+profiler = SamplingProfiler()
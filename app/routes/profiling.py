@@ -0,0 +1,65 @@
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from app.profiling import profiler, PROFILE_MAX_SECONDS
+import hmac
+import os
+
+# Admin endpoints are disabled unless ADMIN_TOKEN is set
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+
+def require_admin(x_admin_token: str = Header(default="")):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+def get_profiling_router(slow_requests):
+    router = APIRouter(
+        prefix="/admin", tags=["Admin"], dependencies=[Depends(require_admin)]
+    )
+
+    @router.post("/profile")
+    async def run_profile(seconds: float = 5, interval_ms: float = 5, format: str = "json"):
+        """
+        Sample every thread's stack for `seconds` and return collapsed stacks.
+        format=collapsed returns `stack count` lines for flamegraph tools.
+        """
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"seconds must be between 0 and {PROFILE_MAX_SECONDS}",
+            )
+        if interval_ms < 1:
+            raise HTTPException(status_code=400, detail="interval_ms must be at least 1")
+
+        try:
+            result = await profiler.run(seconds, interval_ms / 1000)
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+
+        stacks = result["stacks"].most_common()
+        if format == "collapsed":
+            return PlainTextResponse("".join(f"{stack} {count}\n" for stack, count in stacks))
+        return {
+            "samples": result["samples"],
+            "interval_ms": result["interval_ms"],
+            "stacks": [{"stack": stack, "count": count} for stack, count in stacks],
+        }
+
+    @router.get("/slow-requests")
+    async def get_slow_requests(limit: int = 50):
+        """Most recent requests over the latency threshold, newest first"""
+        requests = list(slow_requests.requests)[::-1]
+        return {
+            "threshold_ms": slow_requests.threshold_ms,
+            "requests": requests[:limit],
+        }
+
+    @router.delete("/slow-requests")
+    async def clear_slow_requests():
+        slow_requests.requests.clear()
+        return {"status": "cleared"}
+
+    return router
@@ -2,10 +2,18 @@ from fastapi import APIRouter, HTTPException
 from datetime import datetime, timezone
 from app.models import TransferRequest
 from app.utils.billers import get_billers
+import asyncio
 import uuid
 import httpx
 import os
 
+# Idempotency keys of recent inter-bank credits kept on each account
+CREDIT_KEY_HISTORY = 500
+
+
+class CreditAlreadyApplied(Exception):
+    """An inter-bank credit with this idempotency key was already applied"""
+
 
 def get_transactions_router(accounts, transactions, client, bank_name: str):
     router = APIRouter(tags=["Transactions"])
@@ -45,6 +53,8 @@ def get_transactions_router(accounts, transactions, client, bank_name: str):
 
         account_id = data["account_id"]
         amount = data["amount"]
+        idempotency_key = data.get("idempotency_key")
+
         print(f"🔍 Checking account {account_id} in {bank_name} database...")
         acc = await accounts.find_one(
             {"account_id": account_id, "bank_name": bank_name}
@@ -56,26 +66,59 @@ def get_transactions_router(accounts, transactions, client, bank_name: str):
             raise HTTPException(status_code=404, detail="Account not found")
         print(f"✅ Account found: {account_id}")
 
-        await accounts.update_one(
-            {"account_id": account_id, "bank_name": bank_name},
-            {"$inc": {"balance": amount}},
-        )
+        # The clearing house retries credits it could not confirm, possibly
+        # while the first attempt is still running. The key is recorded on the
+        # account in the same conditional write as the balance, so exactly
+        # one attempt applies it.
+        update = {"$inc": {"balance": amount}}
+        if idempotency_key:
+            print(f"🔑 Idempotency key provided: {idempotency_key}")
+            update["$push"] = {
+                "credit_keys": {"$each": [idempotency_key], "$slice": -CREDIT_KEY_HISTORY}
+            }
+
+        def ensure_not_applied(account):
+            if idempotency_key and idempotency_key in (account.get("credit_keys") or []):
+                raise CreditAlreadyApplied()
+
+        transaction_record = {
+            # A fixed id lets a retry re-record the row without duplicating it
+            "id": f"credit-{idempotency_key}" if idempotency_key else str(uuid.uuid4()),
+            "bank": bank_name,
+            "account_id": account_id,
+            "type": "CREDIT",
+            "amount": amount,
+            "description": f"Inter-bank transfer from {data.get('from_bank', 'external')}",
+            "timestamp": now.isoformat(),
+        }
+        if idempotency_key:
+            transaction_record["idempotency_key"] = idempotency_key
+
+        try:
+            await accounts.update_one(
+                {"account_id": account_id, "bank_name": bank_name},
+                update,
+                document=acc,
+                check=ensure_not_applied,
+            )
+        except CreditAlreadyApplied:
+            # An earlier attempt may have failed after the credit but before
+            # its ledger row was written
+            if not await transactions.find_one({"id": transaction_record["id"]}):
+                try:
+                    await transactions.insert_one(transaction_record)
+                except Exception as e:
+                    # 409: a concurrent retry recorded it first
+                    if getattr(e, "status_code", None) != 409:
+                        raise
+            print(f"✅ Duplicate credit detected. Returning cached response.")
+            return {"status": "credited", "duplicate": True}
 
         print(
             f"✅ Credit Successful. {amount} to {account_id} in {bank_name} database..."
         )
 
-        await transactions.insert_one(
-            {
-                "id": str(uuid.uuid4()),
-                "bank": bank_name,
-                "account_id": account_id,
-                "type": "CREDIT",
-                "amount": amount,
-                "description": f"Inter-bank transfer from {data.get('from_bank', 'external')}",
-                "timestamp": now.isoformat(),
-            }
-        )
+        await transactions.insert_one(transaction_record)
 
         print("✅ Transaction recorded")
         print(f"{'='*60}\n")
@@ -85,6 +128,7 @@ def get_transactions_router(accounts, transactions, client, bank_name: str):
     @router.post("/transfer")
     async def transfer_funds(req: TransferRequest):
         to_bank = req.to_bank.lower()
+        is_local = to_bank == bank_name
 
         print(f"\n{'='*60}")
         print("📨 Transfer Initiated")
@@ -92,41 +136,67 @@ def get_transactions_router(accounts, transactions, client, bank_name: str):
         print(f"Request data: {req}")
         print(f"API Bank: {bank_name}")
 
+        def ensure_funds(account):
+            if account["balance"] < req.amount:
+                raise HTTPException(status_code=400, detail="Insufficient funds")
+
+        # Stage 1: validate. Sender and receiver lookups are independent, so
+        # run them concurrently. Inter-bank receivers live in the other bank
+        # and are never looked up here.
         account_name = req.from_account
         print(f"🔍 Checking account {account_name} in {bank_name} database...")
-        sender = await accounts.find_one(
-            {"account_id": req.from_account, "bank_name": bank_name}
-        )
-        if not sender:
-            error_msg = f"Account {account_name} not found"
-            print(f"❌ {error_msg}")
-            raise HTTPException(status_code=404, detail="Sender not found")
+        receiver_lookup = None
+        if is_local:
+            receiver_lookup = asyncio.create_task(
+                accounts.find_one({"account_id": req.to_account, "bank_name": bank_name})
+            )
 
-        print(f"✅ Account found: {account_name}")
+        try:
+            sender = await accounts.find_one(
+                {"account_id": req.from_account, "bank_name": bank_name}
+            )
+            if not sender:
+                error_msg = f"Account {account_name} not found"
+                print(f"❌ {error_msg}")
+                raise HTTPException(status_code=404, detail="Sender not found")
+            print(f"✅ Account found: {account_name}")
 
-        receiver = await accounts.find_one(
-            {"account_id": req.to_account, "bank_name": bank_name}
-        )
+            # Fail fast without waiting on the receiver lookup
+            ensure_funds(sender)
 
-        if sender["balance"] < req.amount:
-            raise HTTPException(status_code=400, detail="Insufficient funds")
-        if to_bank == bank_name:
-            receiver_name = req.to_account
-            print(f"🔍 Checking account {receiver_name} in {bank_name} database...")
-            if not receiver:
-                error_msg = f"Account {receiver_name} not found"
-                print(f"❌ {error_msg}")
-                raise HTTPException(status_code=404, detail="Receiver not found")
-            print(f"✅ Account found: {receiver_name}")
+            receiver = None
+            if receiver_lookup:
+                receiver_name = req.to_account
+                print(f"🔍 Checking account {receiver_name} in {bank_name} database...")
+                receiver = await receiver_lookup
+                if not receiver:
+                    error_msg = f"Account {receiver_name} not found"
+                    print(f"❌ {error_msg}")
+                    raise HTTPException(status_code=404, detail="Receiver not found")
+                print(f"✅ Account found: {receiver_name}")
+        finally:
+            if receiver_lookup:
+                if not receiver_lookup.done():
+                    receiver_lookup.cancel()
+                elif not receiver_lookup.cancelled():
+                    # Validation may have failed before the lookup was awaited;
+                    # retrieve its error so asyncio does not report it as lost
+                    receiver_lookup.exception()
 
         # Build human-readable description
-        if to_bank and to_bank != bank_name:
+        if to_bank and not is_local:
             description = f"Inter-bank transfer to {to_bank} / {req.to_account}"
         else:
             description = f"Transfer to {req.to_account}"
+
+        # Stage 2: debit, reusing the fetched sender document instead of
+        # re-querying it. If a concurrent write changed the account since,
+        # the update re-reads it and checks the funds again.
         await accounts.update_one(
             {"account_id": req.from_account, "bank_name": bank_name},
             {"$inc": {"balance": -req.amount}},
+            document=sender,
+            check=ensure_funds,
         )
         print(
             f"✅ Debit Successful. {req.amount} from {account_name} in {bank_name} database..."
@@ -148,14 +218,15 @@ def get_transactions_router(accounts, transactions, client, bank_name: str):
 
         print(f"✅ Transaction Added")
 
-        # Credit ONLY if:
+        # Stage 3: credit ONLY if:
         # - same-bank transfer OR
         # - incoming interbank transfer
         print(f"from bank {req.from_bank}, to bank: {to_bank}, bank: {bank_name}")
-        if to_bank == bank_name:
+        if is_local:
             await accounts.update_one(
                 {"account_id": req.to_account, "bank_name": bank_name},
                 {"$inc": {"balance": req.amount}},
+                document=receiver,
             )
 
             print(
@@ -185,7 +256,7 @@ def get_transactions_router(accounts, transactions, client, bank_name: str):
         print(f"{'='*60}\n")
         return {
             "status": "debited",
-            "inter_bank": bool(to_bank and to_bank != bank_name),
+            "inter_bank": bool(to_bank and not is_local),
         }
 
     return router
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Refilling token bucket shared by concurrent coroutines.
+    Tokens refill continuously at `rate` per second up to `capacity`.
+    The balance may go negative when actual costs are charged after the
+    fact; callers then wait until the debt has been repaid.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self.paused_until:
+            start = max(self.updated_at, self.paused_until)
+            self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self.updated_at = now
+
+    def delay_for(self, amount: float = 1.0) -> float:
+        """Seconds until `amount` tokens would be available"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        pause = max(0.0, self.paused_until - self.updated_at)
+        if self.tokens >= amount:
+            return pause
+        if self.rate <= 0:
+            return float("inf")
+        return pause + (amount - self.tokens) / self.rate
+
+    def try_acquire(self, amount: float = 1.0) -> bool:
+        """Take `amount` tokens if available right now"""
+        if self.delay_for(amount) > 0:
+            return False
+        self.tokens -= amount
+        return True
+
+    async def acquire(self, amount: float = 1.0):
+        """Wait until `amount` tokens are available, then take them"""
+        async with self._lock:
+            while True:
+                delay = self.delay_for(amount)
+                if delay <= 0:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep(delay)
+
+    def charge(self, amount: float):
+        """Debit tokens without waiting (e.g. to settle an actual cost)"""
+        self._refill()
+        self.tokens -= amount
+
+    def pause(self, seconds: float):
+        """Stop refilling and handing out tokens for `seconds`"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+        self.paused_until = max(self.paused_until, self.updated_at + seconds)
@@ -1,13 +1,32 @@
 from fastapi import FastAPI, HTTPException
 from app.models import InterBankTransferRequest
+from app.admission import AdmissionControl, SETTLEMENT_TOKEN, SETTLEMENT_TOKEN_HEADER
+from app.profiling import SlowRequestCapture, SlowRequestLog, TimedJSONResponse, timed_stage
+from app.routes.profiling import get_profiling_router
+import asyncio
 import httpx
+import os
+import uuid
 
 BANKS = {
     "gcash": "http://localhost:8000",
     "bpi": "http://localhost:8001",
 }
 
-app = FastAPI(title="Clearing House")
+# Retries for the credit leg when the receiving bank sheds or throttles it.
+# The sender is already debited at that point, so giving up loses money.
+CREDIT_MAX_ATTEMPTS = int(os.getenv("CREDIT_MAX_ATTEMPTS", "5"))
+CREDIT_RETRY_AFTER_MAX = float(os.getenv("CREDIT_RETRY_AFTER_MAX", "10"))
+RETRYABLE_STATUS = {429, 503}
+
+# Lets the banks tell settlement legs apart from ordinary clients
+SETTLEMENT_HEADERS = {SETTLEMENT_TOKEN_HEADER: SETTLEMENT_TOKEN} if SETTLEMENT_TOKEN else {}
+
+app = FastAPI(title="Clearing House", default_response_class=TimedJSONResponse)
+slow_requests = SlowRequestLog()
+app.add_middleware(AdmissionControl, route_limits={"/interbank-transfer": 32})
+app.add_middleware(SlowRequestCapture, log=slow_requests)
+app.include_router(get_profiling_router(slow_requests))
 
 
 @app.post("/interbank-transfer")
@@ -18,32 +37,61 @@ async def interbank_transfer(req: InterBankTransferRequest):
     if req.from_bank not in BANKS or req.to_bank not in BANKS:
         raise HTTPException(status_code=400, detail="Unknown bank")
 
-    async with httpx.AsyncClient() as client:
+    async with httpx.AsyncClient(headers=SETTLEMENT_HEADERS) as client:
         # Step 1: Debit sender bank
-        debit_resp = await client.post(
-            f"{BANKS[req.from_bank]}/transfer",
-            json={
-                "from_account": req.from_account,
-                "to_account": req.to_account,
-                "amount": req.amount,
-                "to_bank": req.to_bank,
-            },
-        )
+        with timed_stage("debit_leg"):
+            debit_resp = await client.post(
+                f"{BANKS[req.from_bank]}/transfer",
+                json={
+                    "from_account": req.from_account,
+                    "to_account": req.to_account,
+                    "amount": req.amount,
+                    "to_bank": req.to_bank,
+                },
+            )
 
         if debit_resp.status_code != 200:
             raise HTTPException(status_code=400, detail="Debit failed")
 
         # Step 2: Credit receiver bank
-        credit_resp = await client.post(
-            f"{BANKS[req.to_bank]}/internal/credit",
-            json={
-                "account_id": req.to_account,
-                "amount": req.amount,
-                "from_bank": req.from_bank,
-            },
-        )
+        with timed_stage("credit_leg"):
+            credit_resp = await post_credit(
+                client,
+                f"{BANKS[req.to_bank]}/internal/credit",
+                {
+                    "account_id": req.to_account,
+                    "amount": req.amount,
+                    "from_bank": req.from_bank,
+                    "idempotency_key": str(uuid.uuid4()),
+                },
+            )
 
         if credit_resp.status_code != 200:
             raise HTTPException(status_code=500, detail="Credit failed")
 
     return {"message": "Inter-bank transfer completed"}
+
+
+async def post_credit(client: httpx.AsyncClient, url: str, payload: dict):
+    """
+    Post the credit leg, retrying 429/503 responses after their
+    Retry-After delay and connection failures after a second.
+    The idempotency key makes retries safe.
+    """
+    for attempt in range(1, CREDIT_MAX_ATTEMPTS + 1):
+        try:
+            resp = await client.post(url, json=payload)
+        except httpx.TransportError as e:
+            if attempt == CREDIT_MAX_ATTEMPTS:
+                raise
+            print(f"Credit leg failed ({e!r}), retrying")
+            await asyncio.sleep(1)
+            continue
+        if resp.status_code not in RETRYABLE_STATUS or attempt == CREDIT_MAX_ATTEMPTS:
+            return resp
+        try:
+            retry_after = float(resp.headers.get("retry-after", "1"))
+        except ValueError:
+            retry_after = 1.0
+        print(f"Credit leg got {resp.status_code}, retrying in {retry_after}s")
+        await asyncio.sleep(min(retry_after, CREDIT_RETRY_AFTER_MAX))
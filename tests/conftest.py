@@ -0,0 +1,20 @@
+import base64
+import os
+
+import azure.cosmos
+
+# app.database connects at import time; point it at a client that never
+# touches the network. Tests build CosmosContainer over tests.fakes instead.
+os.environ.setdefault("COSMOS_ENDPOINT", "https://localhost:8081")
+os.environ.setdefault("COSMOS_KEY", base64.b64encode(b"test-key").decode())
+
+
+class _OfflineCosmosClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def list_databases(self):
+        return []
+
+
+azure.cosmos.CosmosClient = _OfflineCosmosClient
@@ -0,0 +1,93 @@
+import re
+import threading
+import time
+import uuid
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosHttpResponseError
+
+_CONDITION = re.compile(r"c\.(\w+) = (?:'([^']*)'|(-?[\d.]+))")
+
+
+def http_error(status_code: int, headers: dict = None):
+    error = CosmosHttpResponseError(status_code=status_code, message=f"status {status_code}")
+    error.headers = headers or {}
+    return error
+
+
+class FakeCosmosContainer:
+    """
+    In-memory stand-in for an azure-cosmos ContainerProxy. Calls sleep for
+    `latency` seconds (they run in worker threads) so concurrent requests
+    interleave, and replace_item honours etag/match_condition like Cosmos.
+    Exceptions queued in `faults` are raised by the next calls.
+    """
+
+    def __init__(self, docs=None, latency: float = 0.0, request_charge: float = 1.0):
+        self.docs = {}
+        for doc in docs or []:
+            self._store(dict(doc))
+        self.latency = latency
+        self.request_charge = request_charge
+        self.faults = []
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _store(self, doc):
+        doc["_etag"] = uuid.uuid4().hex
+        self.docs[doc["id"]] = doc
+
+    def _call(self, response_hook, result=None):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls += 1
+            if self.faults:
+                raise self.faults.pop(0)
+        if response_hook:
+            response_hook({"x-ms-request-charge": str(self.request_charge)}, result)
+
+    def query_items(self, query, enable_cross_partition_query=True, response_hook=None, **kwargs):
+        self._call(response_hook)
+        conditions = {
+            key: text if number == "" else float(number)
+            for key, text, number in _CONDITION.findall(query)
+        }
+        with self._lock:
+            return [
+                dict(doc)
+                for doc in self.docs.values()
+                if all(doc.get(key) == value for key, value in conditions.items())
+            ]
+
+    def create_item(self, body, response_hook=None, **kwargs):
+        self._call(response_hook)
+        with self._lock:
+            if body["id"] in self.docs:
+                raise http_error(409)
+            self._store(dict(body))
+        return body
+
+    def replace_item(self, item, body, etag=None, match_condition=None, response_hook=None, **kwargs):
+        self._call(response_hook)
+        with self._lock:
+            current = self.docs.get(item)
+            if current is None:
+                raise http_error(404)
+            if match_condition == MatchConditions.IfNotModified and current["_etag"] != etag:
+                raise CosmosAccessConditionFailedError(status_code=412, message="etag mismatch")
+            self._store(dict(body))
+            return dict(self.docs[item])
+
+    def execute_item_batch(self, batch_operations, partition_key, response_hook=None, **kwargs):
+        self._call(response_hook)
+        with self._lock:
+            for operation, (doc,) in batch_operations:
+                assert operation == "upsert"
+                self._store(dict(doc))
+        return []
+
+    def find(self, **conditions):
+        return [
+            doc for doc in self.docs.values()
+            if all(doc.get(key) == value for key, value in conditions.items())
+        ]
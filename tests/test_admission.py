@@ -0,0 +1,123 @@
+import asyncio
+
+import httpx
+from fastapi import FastAPI
+
+import clearing_house.main as clearing_house
+from app.admission import EXEMPT_CLIENTS, AdmissionControl
+
+
+def build_app(handler_delay: float = 0.0, **admission):
+    app = FastAPI()
+
+    @app.post("/transfer")
+    async def transfer(data: dict):
+        await asyncio.sleep(handler_delay)
+        return {"status": "debited"}
+
+    @app.post("/internal/credit")
+    async def credit(data: dict):
+        await asyncio.sleep(handler_delay)
+        return {"status": "credited"}
+
+    app.add_middleware(AdmissionControl, **admission)
+    return app
+
+
+async def post_many(app, requests, client_host="203.0.113.7"):
+    transport = httpx.ASGITransport(app=app, client=(client_host, 4321))
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await asyncio.gather(
+            *[client.post(path, json=body, headers=headers) for path, body, headers in requests]
+        )
+
+
+def test_spoofed_client_id_does_not_bypass_rate_limit():
+    app = build_app(client_rate=2, account_rate=0, exempt_clients=set())
+    requests = [
+        ("/transfer", {}, {"x-client-id": value})
+        for value in ["127.0.0.1"] + [f"client-{i}" for i in range(9)]
+    ]
+
+    responses = asyncio.run(post_many(app, requests))
+
+    statuses = [r.status_code for r in responses]
+    assert statuses.count(200) == 4  # burst capacity is twice the rate
+    assert statuses.count(429) == 6
+
+
+def test_client_id_header_trusted_from_configured_proxy():
+    app = build_app(
+        client_rate=1, account_rate=0, exempt_clients=set(), trusted_proxies={"10.0.0.1"}
+    )
+    requests = [("/transfer", {}, {"x-client-id": f"client-{i}"}) for i in range(5)]
+
+    responses = asyncio.run(post_many(app, requests, client_host="10.0.0.1"))
+
+    assert all(r.status_code == 200 for r in responses)
+
+
+def test_loopback_is_not_exempt_by_default():
+    assert not EXEMPT_CLIENTS
+    app = build_app(client_rate=5, account_rate=0)
+    requests = [("/transfer", {}, {}) for _ in range(20)]
+
+    responses = asyncio.run(post_many(app, requests, client_host="127.0.0.1"))
+
+    assert any(r.status_code == 429 for r in responses)
+
+
+def test_settlement_token_exempts_debit_legs_from_rate_limits():
+    app = build_app(client_rate=5, account_rate=5, settlement_token="s3cret")
+    requests = [
+        ("/transfer", {"from_account": "BPI001"}, {"x-settlement-token": "s3cret"})
+        for _ in range(50)
+    ]
+    forged = [("/transfer", {}, {"x-settlement-token": "guess"}) for _ in range(20)]
+
+    responses = asyncio.run(post_many(app, requests))
+    forged_responses = asyncio.run(post_many(app, forged))
+
+    assert all(r.status_code == 200 for r in responses)
+    assert any(r.status_code == 429 for r in forged_responses)
+
+
+def test_settlement_credits_are_never_shed():
+    app = build_app(
+        handler_delay=0.02,
+        max_concurrency=1,
+        max_queue=2,
+        queue_timeout=0.01,
+        client_rate=0,
+        account_rate=0,
+    )
+    requests = [("/transfer", {}, {})] * 10 + [
+        ("/internal/credit", {"account_id": "GCASH001", "amount": 1}, {})
+    ] * 10
+
+    responses = asyncio.run(post_many(app, requests))
+
+    transfers, credits = responses[:10], responses[10:]
+    assert any(r.status_code == 503 for r in transfers)
+    assert all(r.status_code == 200 for r in credits)
+
+
+def test_credit_leg_retries_after_retry_after(monkeypatch):
+    monkeypatch.setattr(clearing_house, "CREDIT_RETRY_AFTER_MAX", 0)
+    keys = []
+    statuses = iter([503, 429, 200])
+
+    def handler(request):
+        keys.append(request.content)
+        return httpx.Response(next(statuses), headers={"retry-after": "1"})
+
+    async def post():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await clearing_house.post_credit(
+                client, "http://bank/internal/credit", {"idempotency_key": "k1"}
+            )
+
+    response = asyncio.run(post())
+
+    assert response.status_code == 200
+    assert len(keys) == 3 and len(set(keys)) == 1
@@ -0,0 +1,128 @@
+import asyncio
+
+import httpx
+import pytest
+
+import app.database as database
+from app.database import (
+    CosmosContainer,
+    StorageError,
+    StorageThrottledError,
+    StorageUnavailableError,
+)
+from app.utils.token_bucket import TokenBucket
+from tests.fakes import FakeCosmosContainer, http_error
+
+ACCOUNT = {"id": "1", "type": "account", "account_id": "BPI001", "bank_name": "bpi", "balance": 100}
+
+
+def test_throttled_calls_are_retried(monkeypatch):
+    monkeypatch.setattr(database, "COSMOS_BACKOFF_BASE", 0.001)
+    fake = FakeCosmosContainer([ACCOUNT])
+    fake.faults = [http_error(429, {"x-ms-retry-after-ms": "1"})] * 2
+    container = CosmosContainer(fake)
+
+    found = asyncio.run(container.find_one({"account_id": "BPI001"}))
+
+    assert found["balance"] == 100
+    assert fake.calls == 3
+
+
+def test_exhausted_throttle_retries_raise_throttled(monkeypatch):
+    monkeypatch.setattr(database, "COSMOS_MAX_RETRIES", 1)
+    monkeypatch.setattr(database, "COSMOS_BACKOFF_BASE", 0.001)
+    fake = FakeCosmosContainer()
+    fake.faults = [http_error(429, {"x-ms-retry-after-ms": "1"})] * 5
+
+    with pytest.raises(StorageThrottledError):
+        asyncio.run(CosmosContainer(fake).find_one({"account_id": "BPI001"}))
+
+
+@pytest.mark.parametrize(
+    "status_code, transient", [(400, False), (404, False), (409, False), (503, True), (408, True)]
+)
+def test_errors_are_classified(status_code, transient):
+    fake = FakeCosmosContainer()
+    fake.faults = [http_error(status_code)]
+
+    with pytest.raises(StorageError) as raised:
+        asyncio.run(CosmosContainer(fake).find({"account_id": "BPI001"}))
+
+    assert isinstance(raised.value, StorageUnavailableError) is transient
+    assert raised.value.status_code == status_code
+
+
+def test_cancelled_call_is_billed_its_actual_charge():
+    fake = FakeCosmosContainer([ACCOUNT], latency=0.05, request_charge=5)
+    budget = TokenBucket(0.001, capacity=100)
+    container = CosmosContainer(fake, ru_budget=budget)
+
+    async def cancel_midway():
+        task = asyncio.create_task(container.find_one({"account_id": "BPI001"}))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Let the worker thread finish and post its settlement
+        await asyncio.sleep(0.1)
+
+    asyncio.run(cancel_midway())
+
+    assert budget.tokens == pytest.approx(95, abs=0.01)
+    assert container.estimated_charges["find_one"] == pytest.approx(1.8)
+
+
+def _app_raising(monkeypatch, exc):
+    import app.main as main
+
+    class Accounts:
+        async def find_one(self, query, projection=None):
+            raise exc
+
+    monkeypatch.setattr(
+        main,
+        "get_database",
+        lambda bank_name: {
+            "client": None,
+            "accounts": Accounts(),
+            "transactions": None,
+            "bank_name": bank_name,
+        },
+    )
+    return main.create_app("bpi")
+
+
+@pytest.mark.parametrize(
+    "exc, status_code",
+    [
+        (StorageError("syntax error", status_code=400), 500),
+        (StorageUnavailableError("service unavailable", status_code=503), 503),
+        (StorageThrottledError("throttled", retry_after=2.5), 503),
+    ],
+)
+def test_storage_errors_map_to_http_status(monkeypatch, exc, status_code):
+    app = _app_raising(monkeypatch, exc)
+
+    async def get_balance():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/balance/BPI001")
+
+    response = asyncio.run(get_balance())
+
+    assert response.status_code == status_code
+    if isinstance(exc, StorageThrottledError):
+        assert response.headers["retry-after"] == "3"
+
+
+def test_batch_charges_do_not_inflate_point_read_reservations():
+    fake = FakeCosmosContainer([ACCOUNT])
+    container = CosmosContainer(fake, ru_budget=TokenBucket(10000))
+
+    fake.request_charge = 1000
+    asyncio.run(container.bulk_upsert([{"id": "t1", "type": "debit"}]))
+    fake.request_charge = 1
+    asyncio.run(container.find_one({"account_id": "BPI001"}))
+
+    assert container.estimated_charges["bulk_upsert"] > 100
+    assert container.estimated_charges["find_one"] == 1.0
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+import app.ledger as ledger
+from app.database import CosmosContainer
+from app.ledger import LedgerWriter
+from tests.fakes import FakeCosmosContainer
+
+
+def row(i, **extra):
+    return {"id": f"t{i}", "type": "debit", "account_id": "BPI001", "amount": i, **extra}
+
+
+class FailingTransactions:
+    """Transactions container whose bulk writes always fail"""
+
+    async def bulk_upsert(self, documents):
+        raise ConnectionError("container unreachable")
+
+    async def find_one(self, query, projection=None):
+        return None
+
+    async def find(self, query):
+        return []
+
+
+async def crash(writer):
+    """Stop a writer without committing or flushing anything"""
+    for task in writer._tasks:
+        task.cancel()
+    await asyncio.gather(*writer._tasks, return_exceptions=True)
+    writer._wal.close()
+    writer._ack.close()
+    writer._lock_file.close()
+
+
+def test_concurrent_inserts_share_one_fsync(tmp_path, monkeypatch):
+    fsyncs = []
+    real_fsync = ledger.os.fsync
+    monkeypatch.setattr(ledger.os, "fsync", lambda fd: (fsyncs.append(fd), real_fsync(fd)))
+    writer = LedgerWriter(FailingTransactions(), tmp_path)
+
+    async def run():
+        await writer.start()
+        await asyncio.gather(*[writer.insert_one(row(i)) for i in range(50)])
+        wal = (tmp_path / "ledger.wal").read_text().splitlines()
+        await crash(writer)
+        return wal
+
+    wal = asyncio.run(run())
+
+    assert len(wal) == 50
+    assert len(fsyncs) == 1
+
+
+def test_rows_are_flushed_in_bulk_and_wal_compacted(tmp_path):
+    fake = FakeCosmosContainer()
+    writer = LedgerWriter(CosmosContainer(fake), tmp_path)
+
+    async def run():
+        await writer.start()
+        await asyncio.gather(*[writer.insert_one(row(i)) for i in range(250)])
+        await asyncio.sleep(0.3)
+        await writer.stop()
+
+    asyncio.run(run())
+
+    assert len(fake.docs) == 250
+    assert fake.calls == 3  # 100-operation transactional batches
+    assert (tmp_path / "ledger.wal").read_text() == ""
+    assert (tmp_path / "ledger.ack").read_text() == ""
+
+
+def test_compaction_keeps_only_unflushed_rows(tmp_path):
+    writer = LedgerWriter(FailingTransactions(), tmp_path)
+
+    async def run():
+        await writer.start()
+        await asyncio.gather(*[writer.insert_one(row(i)) for i in range(4)])
+        for doc_id in ("t0", "t1"):
+            writer._pending.pop(doc_id)
+        await writer._compact()
+        await crash(writer)
+
+    asyncio.run(run())
+
+    wal = [json.loads(line)["id"] for line in (tmp_path / "ledger.wal").read_text().splitlines()]
+    assert wal == ["t2", "t3"]
+
+
+def test_unflushed_rows_are_recovered_after_crash(tmp_path):
+    async def write_then_crash():
+        writer = LedgerWriter(FailingTransactions(), tmp_path)
+        await writer.start()
+        await asyncio.gather(*[writer.insert_one(row(i)) for i in range(3)])
+        await crash(writer)
+
+    asyncio.run(write_then_crash())
+    # One row already made it to the container, and the last append was torn
+    with open(tmp_path / "ledger.ack", "a") as f:
+        f.write("t0\n")
+    with open(tmp_path / "ledger.wal", "a") as f:
+        f.write('{"id": "t9", "ty')
+
+    fake = FakeCosmosContainer()
+    writer = LedgerWriter(CosmosContainer(fake), tmp_path)
+
+    async def recover():
+        await writer.start()
+        pending = list(writer._pending)
+        await writer.stop()
+        return pending
+
+    assert asyncio.run(recover()) == ["t1", "t2"]
+    assert sorted(fake.docs) == ["t1", "t2"]
+
+
+def test_rows_appended_after_a_torn_write_survive_the_next_crash(tmp_path):
+    async def write_then_crash(i):
+        writer = LedgerWriter(FailingTransactions(), tmp_path)
+        await writer.start()
+        await writer.insert_one(row(i))
+        await crash(writer)
+        return list(writer._pending)
+
+    asyncio.run(write_then_crash(1))
+    with open(tmp_path / "ledger.wal", "a") as f:
+        f.write('{"id": "t9", "ty')
+
+    assert asyncio.run(write_then_crash(2)) == ["t1", "t2"]
+    wal = (tmp_path / "ledger.wal").read_text().splitlines()
+    assert [json.loads(line)["id"] for line in wal] == ["t1", "t2"]
+
+
+def test_rows_committed_after_a_cancelled_compaction_reach_the_new_wal(tmp_path, monkeypatch):
+    monkeypatch.setattr(ledger, "LEDGER_FLUSH_INTERVAL", 60)
+    real_replace = ledger._replace_and_sync
+
+    def slow_replace(path, data):
+        time.sleep(0.05)
+        real_replace(path, data)
+
+    monkeypatch.setattr(ledger, "_replace_and_sync", slow_replace)
+    writer = LedgerWriter(CosmosContainer(FakeCosmosContainer()), tmp_path)
+
+    async def run():
+        await writer.start()
+        await writer.insert_one(row(1))
+        flush = asyncio.create_task(writer._flush())
+        await asyncio.sleep(0.02)
+        flush.cancel()
+        await asyncio.gather(flush, return_exceptions=True)
+        await writer.insert_one(row(2))
+        await crash(writer)
+
+    asyncio.run(run())
+
+    wal = (tmp_path / "ledger.wal").read_text().splitlines()
+    assert [json.loads(line)["id"] for line in wal] == ["t2"]
+
+
+def test_reads_include_rows_not_yet_flushed(tmp_path):
+    writer = LedgerWriter(FailingTransactions(), tmp_path)
+
+    async def run():
+        await writer.start()
+        await writer.insert_one(row(1, idempotency_key="k1", bank="bpi"))
+        found = await writer.find_one({"idempotency_key": "k1", "bank": "bpi"})
+        history = await writer.find({"account_id": "BPI001"})
+        await crash(writer)
+        return found, history
+
+    found, history = asyncio.run(run())
+
+    assert found["id"] == "t1"
+    assert [t["id"] for t in history] == ["t1"]
+
+
+def test_second_writer_cannot_share_wal_dir(tmp_path):
+    first = LedgerWriter(FailingTransactions(), tmp_path)
+    second = LedgerWriter(FailingTransactions(), tmp_path)
+
+    async def run():
+        await first.start()
+        try:
+            with pytest.raises(RuntimeError, match="in use"):
+                await second.start()
+        finally:
+            await crash(first)
+
+    asyncio.run(run())
+
+
+def test_stop_without_start_is_a_no_op(tmp_path):
+    asyncio.run(LedgerWriter(FailingTransactions(), tmp_path).stop())
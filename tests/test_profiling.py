@@ -0,0 +1,72 @@
+import asyncio
+import threading
+
+import httpx
+from fastapi import FastAPI
+
+import app.routes.profiling as profiling_routes
+from app.profiling import SamplingProfiler, SlowRequestCapture, SlowRequestLog, timed_stage
+from app.routes.profiling import get_profiling_router
+
+
+def build_app(monkeypatch):
+    monkeypatch.setattr(profiling_routes, "ADMIN_TOKEN", "secret")
+    log = SlowRequestLog(threshold_ms=0)
+    app = FastAPI()
+
+    @app.get("/balance/{account_id}")
+    async def balance(account_id: str):
+        with timed_stage("cosmos.find_one"):
+            await asyncio.sleep(0)
+        return {"account_id": account_id}
+
+    app.include_router(get_profiling_router(log))
+    app.add_middleware(SlowRequestCapture, log=log)
+    return app, log
+
+
+async def get(app, *paths, method="GET"):
+    transport = httpx.ASGITransport(app=app)
+    headers = {"x-admin-token": "secret"}
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return [await client.request(method, path, headers=headers) for path in paths]
+
+
+def test_slow_requests_record_stages_but_skip_admin(monkeypatch):
+    app, log = build_app(monkeypatch)
+
+    responses = asyncio.run(get(app, "/balance/BPI001", "/admin/slow-requests"))
+    responses += asyncio.run(get(app, "/admin/profile?seconds=0.05", method="POST"))
+
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert [r["path"] for r in log.requests] == ["/balance/BPI001"]
+    assert log.requests[0]["stages"]["cosmos.find_one"]["count"] == 1
+
+
+def test_admin_endpoints_require_token(monkeypatch):
+    app, _ = build_app(monkeypatch)
+
+    async def unauthenticated():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/admin/slow-requests")
+
+    assert asyncio.run(unauthenticated()).status_code == 403
+
+
+def test_profiler_samples_on_dedicated_thread():
+    profiler = SamplingProfiler()
+    sampled_on = []
+    real_sample = profiler._sample
+
+    def record_thread(seconds, interval):
+        sampled_on.append(threading.current_thread().name)
+        return real_sample(seconds, interval)
+
+    profiler._sample = record_thread
+
+    result = asyncio.run(profiler.run(0.05, 0.005))
+
+    assert sampled_on == ["sampling-profiler"]
+    assert result["samples"] > 0
+    assert any(stack.startswith("MainThread;") for stack in result["stacks"])
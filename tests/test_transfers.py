@@ -0,0 +1,151 @@
+import asyncio
+import contextlib
+import gc
+import io
+import logging
+
+import httpx
+from fastapi import FastAPI
+
+from app.database import CosmosContainer, StorageError
+from app.routes.transactions import get_transactions_router
+from tests.fakes import FakeCosmosContainer, http_error
+
+
+def build_bank(sender_balance: int, receiver_balance: int = 0):
+    accounts = FakeCosmosContainer(
+        [
+            {"id": "a1", "type": "account", "account_id": "BPI001", "bank_name": "bpi", "balance": sender_balance},
+            {"id": "a2", "type": "account", "account_id": "BPI002", "bank_name": "bpi", "balance": receiver_balance},
+        ],
+        latency=0.01,
+    )
+    transactions = FakeCosmosContainer(latency=0.01)
+    app = FastAPI()
+    app.include_router(
+        get_transactions_router(
+            CosmosContainer(accounts), CosmosContainer(transactions), None, "bpi"
+        )
+    )
+    return app, accounts, transactions
+
+
+async def post_transfers(app, payloads):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return await asyncio.gather(
+                *[client.post("/transfer", json=payload) for payload in payloads]
+            )
+
+
+async def post_credits(app, payloads):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return await asyncio.gather(
+                *[client.post("/internal/credit", json=payload) for payload in payloads]
+            )
+
+
+def balance(accounts, account_id):
+    return accounts.find(account_id=account_id)[0]["balance"]
+
+
+def test_concurrent_transfers_cannot_overdraw_or_lose_updates():
+    app, accounts, transactions = build_bank(sender_balance=100)
+    payload = {"from_account": "BPI001", "to_account": "BPI002", "amount": 100, "to_bank": "bpi"}
+
+    responses = asyncio.run(post_transfers(app, [payload] * 3))
+
+    statuses = sorted(r.status_code for r in responses)
+    assert statuses == [200, 400, 400]
+    assert balance(accounts, "BPI001") == 0
+    assert balance(accounts, "BPI002") == 100
+    assert len(transactions.docs) == 2
+
+
+def test_concurrent_transfers_keep_balances_and_ledger_in_step():
+    app, accounts, transactions = build_bank(sender_balance=1000)
+    payload = {"from_account": "BPI001", "to_account": "BPI002", "amount": 10, "to_bank": "bpi"}
+
+    responses = asyncio.run(post_transfers(app, [payload] * 10))
+
+    assert all(r.status_code == 200 for r in responses)
+    assert balance(accounts, "BPI001") == 900
+    assert balance(accounts, "BPI002") == 100
+    debits = transactions.find(type="debit")
+    credits = transactions.find(type="credit")
+    assert sum(t["amount"] for t in debits) == 100
+    assert sum(t["amount"] for t in credits) == 100
+
+
+def test_self_transfer_leaves_balance_unchanged():
+    app, accounts, _ = build_bank(sender_balance=100)
+    payload = {"from_account": "BPI001", "to_account": "BPI001", "amount": 40, "to_bank": "bpi"}
+
+    responses = asyncio.run(post_transfers(app, [payload]))
+
+    assert responses[0].status_code == 200
+    assert balance(accounts, "BPI001") == 100
+
+
+CREDIT = {"account_id": "BPI002", "amount": 100, "from_bank": "gcash", "idempotency_key": "k-1"}
+
+
+def test_concurrent_retries_of_a_credit_apply_it_once():
+    app, accounts, transactions = build_bank(sender_balance=0)
+
+    responses = asyncio.run(post_credits(app, [CREDIT] * 5))
+
+    assert all(r.status_code == 200 for r in responses)
+    assert [r.json().get("duplicate", False) for r in responses].count(False) == 1
+    assert balance(accounts, "BPI002") == 100
+    assert len(transactions.find(idempotency_key="k-1")) == 1
+
+
+def test_credit_retried_after_ledger_write_failed_is_not_applied_twice(monkeypatch):
+    import app.main as main
+
+    _, accounts, transactions = build_bank(sender_balance=0)
+    monkeypatch.setattr(
+        main,
+        "get_database",
+        lambda bank_name: {
+            "client": None,
+            "accounts": CosmosContainer(accounts),
+            "transactions": CosmosContainer(transactions),
+            "bank_name": bank_name,
+        },
+    )
+    app = main.create_app("bpi")
+    transactions.faults.append(http_error(503))
+
+    first = asyncio.run(post_credits(app, [CREDIT]))[0]
+    retry = asyncio.run(post_credits(app, [CREDIT]))[0]
+
+    assert first.status_code == 503
+    assert retry.status_code == 200
+    assert retry.json()["duplicate"] is True
+    assert balance(accounts, "BPI002") == 100
+    assert len(transactions.find(idempotency_key="k-1")) == 1
+
+
+def test_failed_receiver_lookup_is_retrieved_when_sender_is_missing(caplog):
+    class Accounts:
+        async def find_one(self, query, projection=None):
+            if query["account_id"] == "BPI002":
+                raise StorageError("receiver lookup failed", status_code=400)
+            await asyncio.sleep(0.01)
+            return None
+
+    app = FastAPI()
+    app.include_router(get_transactions_router(Accounts(), None, None, "bpi"))
+    payload = {"from_account": "BPI001", "to_account": "BPI002", "amount": 10, "to_bank": "bpi"}
+
+    with caplog.at_level(logging.ERROR, logger="asyncio"):
+        responses = asyncio.run(post_transfers(app, [payload]))
+        gc.collect()
+
+    assert responses[0].status_code == 404
+    assert "never retrieved" not in caplog.text